@@ -16,7 +16,7 @@ class SACAgent(Agent, nn.Module):
                  actor_cfg, discount, init_temperature, alpha_lr, alpha_betas,
                  actor_lr, actor_betas, actor_update_frequency, critic_lr,
                  critic_betas, critic_tau, critic_target_update_frequency,
-                 batch_size, learnable_temperature):
+                 batch_size, learnable_temperature, compile_act=False):
         super().__init__()
 
         self.action_range = action_range
@@ -39,18 +39,24 @@ class SACAgent(Agent, nn.Module):
         # set target entropy to -|A|
         self.target_entropy = -action_dim
 
-        # optimizers
+        # optimizers, the betas are converted from the omegaconf lists given by hydra
+        # so that the optimizer states only contain plain python types
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(),
                                                 lr=actor_lr,
-                                                betas=actor_betas)
+                                                betas=tuple(actor_betas))
 
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(),
                                                  lr=critic_lr,
-                                                 betas=critic_betas)
+                                                 betas=tuple(critic_betas))
 
         self.log_alpha_optimizer = torch.optim.Adam([self.log_alpha],
                                                     lr=alpha_lr,
-                                                    betas=alpha_betas)
+                                                    betas=tuple(alpha_betas))
+
+        # the policy is compiled for the (static) observation shapes it is called with
+        self._act_fn = self._act
+        if compile_act and hasattr(torch, 'compile'):
+            self._act_fn = torch.compile(self._act, mode='reduce-overhead', dynamic=False)
 
         self.train()
         self.critic_target.train()
@@ -65,13 +71,20 @@ class SACAgent(Agent, nn.Module):
         return self.log_alpha.exp()
 
     def act(self, obs, sample=False):
-        obs = torch.FloatTensor(obs).to(self.device)
-        obs = obs.unsqueeze(0)
+        obs = torch.as_tensor(obs, dtype=torch.float32, device=self.device)
+        # a leading batch dimension is kept, e.g. for vectorized environments
+        batched = obs.ndim == 2
+        if not batched:
+            obs = obs.unsqueeze(0)
+        with torch.no_grad():
+            action = self._act_fn(obs, sample)
+        assert action.ndim == 2
+        return utils.to_np(action if batched else action[0])
+
+    def _act(self, obs, sample):
         dist = self.actor(obs)
         action = dist.sample() if sample else dist.mean
-        action = action.clamp(*self.action_range)
-        assert action.ndim == 2 and action.shape[0] == 1
-        return utils.to_np(action[0])
+        return action.clamp(*self.action_range)
 
     def update_critic(self, obs, action, reward, next_obs, not_done, logger,
                       step):
@@ -6,9 +6,21 @@ import hydra
 from torch.nn import ModuleDict
 import utils
 import numpy as np
+from contextlib import nullcontext
 from abc import ABC, abstractmethod 
 
 
+def write_checkpoint(checkpoint_dir, checkpoint, state, buffer_snapshots):
+    """Writes the model state and the replay buffer snapshots (relative path -> snapshot) of a checkpoint."""
+
+    torch.save(state, os.path.join(checkpoint_dir, 'checkpoint.pt'))
+
+    for path, snapshot in buffer_snapshots.items():
+        ReplayBuffer.save_snapshot(os.path.join(checkpoint_dir, path), snapshot)
+
+    print("saving checkpoint " + checkpoint + " finished")
+
+
 class MultiAgent(ABC):
 
     @abstractmethod
@@ -16,7 +28,11 @@ class MultiAgent(ABC):
         pass
 
     @abstractmethod
-    def act(self, obs, sample, mode):
+    def set_mode(self, mode):
+        pass
+
+    @abstractmethod
+    def act(self, obs, sample):
         pass
 
     @abstractmethod
@@ -28,7 +44,7 @@ class MultiAgent(ABC):
         pass
 
     @abstractmethod
-    def save_checkpoint(self, dir, step):
+    def save_checkpoint(self, dir, step, executor=None):
         pass
 
     @abstractmethod
@@ -45,6 +61,7 @@ class IndividualMultiAgent(MultiAgent):
         self.mode = mode
         self.randomizer = randomizer
         self.control_mode = control_mode
+        self.obs_stager = utils.PinnedObsStager(self.device)
 
         #instantiate agents and buffers
         self.replay_buffers = {}
@@ -61,10 +78,16 @@ class IndividualMultiAgent(MultiAgent):
                                                         act_spaces[agent],
                                                         replay_buffer_cap,
                                                         self.device,
-                                                        self.randomizer)
+                                                        self.randomizer,
+                                                        np.dtype(cfg.buffer_dtype))
         
         self.agents = ModuleDict(agents)
 
+        # resolved once, to avoid the dictionary lookups per agent in every step
+        self._agent_tuples = tuple((agent, self.agents[agent], self.replay_buffers[agent]) for agent in self.agent_ids)
+
+        self.set_mode(None)
+
         # agents with the name network structure
         self.aggregatable_agents = []
         if self.control_mode == 'unilateral':
@@ -88,34 +111,37 @@ class IndividualMultiAgent(MultiAgent):
             self.agents[agent].reset()
 
 
-    def act(self, obs, sample=False, mode=None):
-        
-        actions = {}
+    def set_mode(self, mode):
 
+        # the context is entered once per act call for all agents
         if mode == "eval":
-            for agent in self.agent_ids:
-                with utils.eval_mode(self.agents[agent]):
-                    actions[agent] = self.agents[agent].act(obs[agent], sample)
+            self._act_context = utils.eval_mode(*self.agents.values())
         
         elif mode == "train":
-            for agent in self.agent_ids:
-                with utils.train_mode(self.agents[agent]):
-                    actions[agent] = self.agents[agent].act(obs[agent], sample)
+            self._act_context = utils.train_mode(*self.agents.values())
 
         elif mode == None:
-            for agent in self.agent_ids:
-                actions[agent] = self.agents[agent].act(obs[agent], sample)
+            self._act_context = nullcontext()
 
         else:
             raise Exception("ERROR: NO VALID ACTING MODE!")
+
+
+    def act(self, obs, sample=False):
+        
+        actions = {}
+
+        with self._act_context:
+            for agent, model, _ in self._agent_tuples:
+                actions[agent] = model.act(self.obs_stager(agent, obs[agent]), sample)
         
         return actions
 
     
     def update(self, loggers, step):
 
-        for agent in self.agent_ids:
-            self.agents[agent].update(self.replay_buffers[agent], loggers[agent], step)
+        for agent, model, replay_buffer in self._agent_tuples:
+            model.update(replay_buffer, loggers[agent], step)
 
 
     def federate(self, aggregate_actor, aggregate_critic, aggregate_target, aggregate_alpha, pre_weight, post_weight, first_post_weight, last_pre_weight):
@@ -279,8 +305,9 @@ class IndividualMultiAgent(MultiAgent):
 
     def add_to_buffer(self, obs, actions, rewards, next_obs, done, dones_no_max):
 
-        for agent in self.agent_ids:
-            self.replay_buffers[agent].add(obs[agent], actions[agent], rewards[agent], next_obs[agent], done, dones_no_max[agent])
+        # transitions of all environments are given with a leading environment dimension
+        for agent, _, replay_buffer in self._agent_tuples:
+            replay_buffer.add_batch(obs[agent], actions[agent], rewards[agent], next_obs[agent], done, dones_no_max[agent])
 
 
     def load_checkpoint(self, dir, checkpoint, device, replay_buffer_capacity):
@@ -290,7 +317,8 @@ class IndividualMultiAgent(MultiAgent):
         checkpoint_dir = os.path.join(dir, checkpoint)
 
         #load model parameters
-        model_checkpoint = torch.load(os.path.join(checkpoint_dir, 'checkpoint.pt'), map_location=device)
+        #tensors are copied into the parameters and optimizer states on the device, so the file can stay on the cpu
+        model_checkpoint = utils.load_torch_checkpoint(os.path.join(checkpoint_dir, 'checkpoint.pt'), map_location='cpu')
         self.agents.load_state_dict(model_checkpoint['models'])
         step = model_checkpoint['step']
         episode = model_checkpoint['episode']
@@ -300,10 +328,12 @@ class IndividualMultiAgent(MultiAgent):
       
         for agent in self.agent_ids:
             self.agents[agent].critic_optimizer.load_state_dict(model_checkpoint['optims'][agent]['critic'])
+            utils.tuple_betas(self.agents[agent].critic_optimizer)
             self.agents[agent].actor_optimizer.load_state_dict(model_checkpoint['optims'][agent]['actor'])
+            utils.tuple_betas(self.agents[agent].actor_optimizer)
             self.agents[agent].log_alpha_optimizer.load_state_dict(model_checkpoint['optims'][agent]['alpha'])
+            utils.tuple_betas(self.agents[agent].log_alpha_optimizer)
 
-        model_checkpoint = torch.load(os.path.join(checkpoint_dir, 'checkpoint.pt'), map_location='cpu')
         torch_randomizer_state = model_checkpoint['torch_randomizer_state']
         cuda_randomizer_state = model_checkpoint['cuda_randomizer_state']
 
@@ -314,32 +344,14 @@ class IndividualMultiAgent(MultiAgent):
             rep_dir = os.path.join(checkpoint_dir, 'replay_buffers')
 
             for agent in self.agent_ids:
-                data = np.load(os.path.join(rep_dir, agent + '.npz'))
-                
-                for i in range(min(step, replay_buffer_capacity)):
-
-                    obs = data['obses'][i]
-                    next_obs = data['next_obses'][i]
-                    action = data['actions'][i]
-                    reward = data['rewards'][i]
-                    not_done = data['not_dones'][i]
-                    not_done_no_max = data['not_dones_no_max'][i]
-
-                    self.replay_buffers[agent].add(obs=obs,
-                                                action=action,
-                                                reward=reward,
-                                                next_obs=next_obs,
-                                                done=not not_done,
-                                                done_no_max=not not_done_no_max)
-                
-                data.close()
+                self.replay_buffers[agent].load(os.path.join(rep_dir, agent), min(step, replay_buffer_capacity))
 
         print("loading checkpoint " + checkpoint + " finished")
 
         return step, episode, min_step_num, env_randomizer_state, initial_randomizer_state, torch_randomizer_state, cuda_randomizer_state
     
 
-    def save_checkpoint(self, dir, step, episode, min_step_num, env_randomizer_state, initial_randomizer_state, torch_randomizer_state, cuda_randomizer_state):
+    def save_checkpoint(self, dir, step, episode, min_step_num, env_randomizer_state, initial_randomizer_state, torch_randomizer_state, cuda_randomizer_state, executor=None):
 
         checkpoint = 'cp_{:d}'.format(step)
 
@@ -353,7 +365,7 @@ class IndividualMultiAgent(MultiAgent):
         state['step'] = step
         state['episode'] = episode
         state['min_step_num'] = min_step_num
-        state['models'] = self.agents.state_dict()
+        state['models'] = utils.cpu_state_copy(self.agents.state_dict())
         state['env_randomizer_state'] = env_randomizer_state
         state['initial_randomizer_state'] = initial_randomizer_state
         state['torch_randomizer_state'] = torch_randomizer_state
@@ -362,31 +374,20 @@ class IndividualMultiAgent(MultiAgent):
         
         for agent in self.agent_ids:
             state['optims'][agent] = {}
-            state['optims'][agent]['critic'] = self.agents[agent].critic_optimizer.state_dict()
-            state['optims'][agent]['actor'] = self.agents[agent].actor_optimizer.state_dict()
-            state['optims'][agent]['alpha'] = self.agents[agent].log_alpha_optimizer.state_dict()
-
-        torch.save(state, os.path.join(checkpoint_dir, 'checkpoint.pt'))
+            state['optims'][agent]['critic'] = utils.cpu_state_copy(self.agents[agent].critic_optimizer.state_dict())
+            state['optims'][agent]['actor'] = utils.cpu_state_copy(self.agents[agent].actor_optimizer.state_dict())
+            state['optims'][agent]['alpha'] = utils.cpu_state_copy(self.agents[agent].log_alpha_optimizer.state_dict())
 
-        #save replay_buffer
-        rep_dir = os.path.join(checkpoint_dir, 'replay_buffers')
-        Path(rep_dir).mkdir(parents=True, exist_ok=True)
-        
+        #snapshot replay_buffer
+        buffer_snapshots = {}
         for agent in self.agent_ids:
+            buffer_snapshots[os.path.join('replay_buffers', agent)] = self.replay_buffers[agent].snapshot()
 
-            #save numpy arrays
-            np_file = os.path.join(rep_dir, agent + '.npz')
-            
-            np.savez(np_file,
-                     obses = self.replay_buffers[agent].obses,
-                     next_obses = self.replay_buffers[agent].next_obses,
-                     actions = self.replay_buffers[agent].actions,
-                     rewards = self.replay_buffers[agent].rewards,
-                     not_dones = self.replay_buffers[agent].not_dones,
-                     not_dones_no_max = self.replay_buffers[agent].not_dones_no_max
-                     )
-            
-        print("saving checkpoint " + checkpoint + " finished")
+        #write to disk, in the background if an executor is given
+        if executor is None:
+            write_checkpoint(checkpoint_dir, checkpoint, state, buffer_snapshots)
+            return None
+        return executor.submit(write_checkpoint, checkpoint_dir, checkpoint, state, buffer_snapshots)
 
     
 
@@ -398,6 +399,7 @@ class SharedMultiAgent(MultiAgent):
         self.device = device
         self.mode = mode
         self.randomizer = randomizer
+        self.obs_stager = utils.PinnedObsStager(self.device)
 
         #instantiate agent and buffer
         cfg.agent.params.obs_dim = obs_space[0]
@@ -409,35 +411,43 @@ class SharedMultiAgent(MultiAgent):
                                             act_space,
                                             replay_buffer_cap,
                                             self.device,
-                                            self.randomizer)
+                                            self.randomizer,
+                                            np.dtype(cfg.buffer_dtype))
+
+        self.set_mode(None)
         
 
     def reset(self):
         self.agent.reset()
 
 
-    def act(self, obs, sample=False, mode=None):
-        
-        actions = {}
+    def set_mode(self, mode):
 
         if mode == "eval":
-            for agent in self.agent_ids:
-                with utils.eval_mode(self.agent):
-                    actions[agent] = self.agent.act(obs[agent], sample)
+            self._act_context = utils.eval_mode(self.agent)
         
         elif mode == "train":
-            for agent in self.agent_ids:
-                with utils.train_mode(self.agents[agent]):
-                    actions[agent] = self.agent.act(obs[agent], sample)
+            self._act_context = utils.train_mode(self.agent)
 
         elif mode == None:
-            for agent in self.agent_ids:
-                actions[agent] = self.agent.act(obs[agent], sample)
+            self._act_context = nullcontext()
 
         else:
             raise Exception("ERROR: NO VALID ACTING MODE!")
+
+
+    def act(self, obs, sample=False):
         
-        return actions
+        # the observations of all agents (and environments) are passed through the shared agent at once
+        obs_batch = np.stack([obs[agent] for agent in self.agent_ids])
+        flat_obs_batch = obs_batch.reshape(-1, obs_batch.shape[-1])
+
+        with self._act_context:
+            actions_batch = self.agent.act(self.obs_stager('shared', flat_obs_batch), sample)
+
+        actions_batch = actions_batch.reshape(*obs_batch.shape[:-1], actions_batch.shape[-1])
+        
+        return dict(zip(self.agent_ids, actions_batch))
 
 
     def update(self, logger, step):
@@ -447,11 +457,17 @@ class SharedMultiAgent(MultiAgent):
 
     def add_to_buffer(self, obs, actions, rewards, next_obs, done, dones_no_max):
         
-        for agent in self.agent_ids:
-            self.replay_buffer.add(obs[agent], actions[agent], rewards[agent], next_obs[agent], done, dones_no_max[agent])
+        # transitions of all environments are given with a leading environment dimension,
+        # those of all agents are inserted into the shared buffer at once
+        self.replay_buffer.add_batch(np.concatenate([obs[agent] for agent in self.agent_ids]),
+                                    np.concatenate([actions[agent] for agent in self.agent_ids]),
+                                    np.concatenate([rewards[agent] for agent in self.agent_ids]),
+                                    np.concatenate([next_obs[agent] for agent in self.agent_ids]),
+                                    np.tile(done, len(self.agent_ids)),
+                                    np.concatenate([dones_no_max[agent] for agent in self.agent_ids]))
 
 
-    def save_checkpoint(self, dir, step, episode, min_step_num, env_randomizer_state, initial_randomizer_state, torch_randomizer_state, cuda_randomizer_state):
+    def save_checkpoint(self, dir, step, episode, min_step_num, env_randomizer_state, initial_randomizer_state, torch_randomizer_state, cuda_randomizer_state, executor=None):
         
         checkpoint = 'cp_{:d}'.format(step)
 
@@ -465,7 +481,7 @@ class SharedMultiAgent(MultiAgent):
         state['step'] = step
         state['episode'] = episode
         state['min_step_num'] = min_step_num
-        state['models'] = self.agent.state_dict()
+        state['models'] = utils.cpu_state_copy(self.agent.state_dict())
         state['env_randomizer_state'] = env_randomizer_state
         state['initial_randomizer_state'] = initial_randomizer_state
         state['torch_randomizer_state'] = torch_randomizer_state
@@ -473,27 +489,18 @@ class SharedMultiAgent(MultiAgent):
         state['optims'] = {}
     
         state['optims'] = {}
-        state['optims']['critic'] = self.agent.critic_optimizer.state_dict()
-        state['optims']['actor'] = self.agent.actor_optimizer.state_dict()
-        state['optims']['alpha'] = self.agent.log_alpha_optimizer.state_dict()
+        state['optims']['critic'] = utils.cpu_state_copy(self.agent.critic_optimizer.state_dict())
+        state['optims']['actor'] = utils.cpu_state_copy(self.agent.actor_optimizer.state_dict())
+        state['optims']['alpha'] = utils.cpu_state_copy(self.agent.log_alpha_optimizer.state_dict())
 
-        torch.save(state, os.path.join(checkpoint_dir, 'checkpoint.pt'))
+        #snapshot replay_buffer
+        buffer_snapshots = {'replay_buffer': self.replay_buffer.snapshot()}
 
-        #save replay_buffer
-        
-        #save numpy arrays
-        np_file = os.path.join(checkpoint_dir, 'replay_buffer.npz')
-        
-        np.savez(np_file,
-                    obses = self.replay_buffer.obses,
-                    next_obses = self.replay_buffer.next_obses,
-                    actions = self.replay_buffer.actions,
-                    rewards = self.replay_buffer.rewards,
-                    not_dones = self.replay_buffer.not_dones,
-                    not_dones_no_max = self.replay_buffer.not_dones_no_max
-                    )
-            
-        print("saving checkpoint " + checkpoint + " finished")
+        #write to disk, in the background if an executor is given
+        if executor is None:
+            write_checkpoint(checkpoint_dir, checkpoint, state, buffer_snapshots)
+            return None
+        return executor.submit(write_checkpoint, checkpoint_dir, checkpoint, state, buffer_snapshots)
 
 
     def load_checkpoint(self, dir, checkpoint, device, replay_buffer_capacity):
@@ -503,7 +510,8 @@ class SharedMultiAgent(MultiAgent):
         checkpoint_dir = os.path.join(dir, checkpoint)
 
         #load model parameters
-        model_checkpoint = torch.load(os.path.join(checkpoint_dir, 'checkpoint.pt'), map_location=device)
+        #tensors are copied into the parameters and optimizer states on the device, so the file can stay on the cpu
+        model_checkpoint = utils.load_torch_checkpoint(os.path.join(checkpoint_dir, 'checkpoint.pt'), map_location='cpu')
         self.agent.load_state_dict(model_checkpoint['models'])
         step = model_checkpoint['step']
         episode = model_checkpoint['episode']
@@ -512,10 +520,12 @@ class SharedMultiAgent(MultiAgent):
         initial_randomizer_state = model_checkpoint['initial_randomizer_state']
       
         self.agent.critic_optimizer.load_state_dict(model_checkpoint['optims']['critic'])
+        utils.tuple_betas(self.agent.critic_optimizer)
         self.agent.actor_optimizer.load_state_dict(model_checkpoint['optims']['actor'])
+        utils.tuple_betas(self.agent.actor_optimizer)
         self.agent.log_alpha_optimizer.load_state_dict(model_checkpoint['optims']['alpha'])
+        utils.tuple_betas(self.agent.log_alpha_optimizer)
 
-        model_checkpoint = torch.load(os.path.join(checkpoint_dir, 'checkpoint.pt'), map_location='cpu')
         torch_randomizer_state = model_checkpoint['torch_randomizer_state']
         cuda_randomizer_state = model_checkpoint['cuda_randomizer_state']
 
@@ -523,25 +533,7 @@ class SharedMultiAgent(MultiAgent):
         #load replay buffer entries
         if self.mode == 'train':
 
-            data = np.load(os.path.join(checkpoint_dir, 'replay_buffer.npz'))
-            
-            for i in range(min(step, replay_buffer_capacity) * len(self.agent_ids)):
-
-                obs = data['obses'][i]
-                next_obs = data['next_obses'][i]
-                action = data['actions'][i]
-                reward = data['rewards'][i]
-                not_done = data['not_dones'][i]
-                not_done_no_max = data['not_dones_no_max'][i]
-
-                self.replay_buffer.add(obs=obs,
-                                        action=action,
-                                        reward=reward,
-                                        next_obs=next_obs,
-                                        done=not not_done,
-                                        done_no_max=not not_done_no_max)
-        
-            data.close()
+            self.replay_buffer.load(os.path.join(checkpoint_dir, 'replay_buffer'), min(step, replay_buffer_capacity) * len(self.agent_ids))
 
         print("loading checkpoint " + checkpoint + " finished")
 
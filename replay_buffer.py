@@ -1,20 +1,24 @@
+import os
+from pathlib import Path
 import numpy as np
 import torch
 
 
 class ReplayBuffer(object):
     """Buffer to store environment transitions."""
-    def __init__(self, obs_shape, action_shape, capacity, device, randomizer):
+    FIELDS = ('obses', 'next_obses', 'actions', 'rewards', 'not_dones', 'not_dones_no_max')
+
+    def __init__(self, obs_shape, action_shape, capacity, device, randomizer, dtype=np.float32):
         self.capacity = capacity
         self.device = device
         self.randomizer = randomizer
 
-        # the proprioceptive obs is stored as float32, pixels obs as uint8
-        obs_dtype = np.float32 if len(obs_shape) == 1 else np.uint8
+        # the proprioceptive obs and the actions are stored as dtype (float32 or float16), pixels obs as uint8
+        obs_dtype = dtype if len(obs_shape) == 1 else np.uint8
 
         self.obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
         self.next_obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-        self.actions = np.empty((capacity, *action_shape), dtype=np.float32)
+        self.actions = np.empty((capacity, *action_shape), dtype=dtype)
         self.rewards = np.empty((capacity, 1), dtype=np.float32)
         self.not_dones = np.empty((capacity, 1), dtype=np.float32)
         self.not_dones_no_max = np.empty((capacity, 1), dtype=np.float32)
@@ -23,6 +27,14 @@ class ReplayBuffer(object):
         self.last_save = 0
         self.full = False
 
+        # tensor views sharing the memory of the arrays, for gathering sampled batches with torch
+        self.tensors = {field: torch.from_numpy(getattr(self, field)) for field in self.FIELDS}
+
+        # on cuda the batches are gathered into pinned buffers, reused once their last copy has finished
+        self.pin_batches = torch.device(self.device).type == 'cuda'
+        self.pinned_batches = {}
+        self.copy_done = None
+
     def __len__(self):
         return self.capacity if self.full else self.idx
 
@@ -37,19 +49,95 @@ class ReplayBuffer(object):
         self.idx = (self.idx + 1) % self.capacity
         self.full = self.full or self.idx == 0
 
+    def add_batch(self, obs, action, reward, next_obs, done, done_no_max):
+        """Adds several transitions given as arrays with a leading batch dimension."""
+        num = len(obs)
+        reward = np.reshape(reward, (num, 1))
+        not_done = np.logical_not(np.reshape(done, (num, 1)))
+        not_done_no_max = np.logical_not(np.reshape(done_no_max, (num, 1)))
+
+        # contiguous writes, split only where the ring buffer wraps around
+        start = 0
+        while start < num:
+            length = min(num - start, self.capacity - self.idx)
+            dst = slice(self.idx, self.idx + length)
+            src = slice(start, start + length)
+
+            np.copyto(self.obses[dst], obs[src])
+            np.copyto(self.actions[dst], action[src])
+            np.copyto(self.rewards[dst], reward[src])
+            np.copyto(self.next_obses[dst], next_obs[src])
+            np.copyto(self.not_dones[dst], not_done[src])
+            np.copyto(self.not_dones_no_max[dst], not_done_no_max[src])
+
+            self.idx = (self.idx + length) % self.capacity
+            self.full = self.full or self.idx == 0
+            start += length
+
+    def bulk_load(self, obses, actions, rewards, next_obses, not_dones, not_dones_no_max):
+        """Replaces the content of the buffer by the given transitions in one copy per array."""
+        num = min(len(obses), self.capacity)
+
+        np.copyto(self.obses[:num], obses[:num])
+        np.copyto(self.actions[:num], actions[:num])
+        np.copyto(self.rewards[:num], rewards[:num])
+        np.copyto(self.next_obses[:num], next_obses[:num])
+        np.copyto(self.not_dones[:num], not_dones[:num])
+        np.copyto(self.not_dones_no_max[:num], not_dones_no_max[:num])
+
+        self.idx = num % self.capacity
+        self.full = num == self.capacity
+
+    def snapshot(self):
+        """Returns copies of the filled part of every array, e.g. for saving them in the background."""
+        return {field: getattr(self, field)[:len(self)].copy() for field in self.FIELDS}
+
+    @staticmethod
+    def save_snapshot(dir, snapshot):
+        """Stores every array of a snapshot as an uncompressed .npy file in the given directory."""
+        Path(dir).mkdir(parents=True, exist_ok=True)
+        for field, array in snapshot.items():
+            np.save(os.path.join(dir, field + '.npy'), array)
+
+    def load(self, path, num_entries):
+        """Loads transitions saved by 'save_snapshot' or, for older checkpoints, from the .npz archive at path."""
+        if os.path.isdir(path):
+            data = {field: np.load(os.path.join(path, field + '.npy'), mmap_mode='r') for field in self.FIELDS}
+            self.bulk_load(**{field: data[field][:num_entries] for field in self.FIELDS})
+        else:
+            data = np.load(path + '.npz')
+            self.bulk_load(**{field: data[field][:num_entries] for field in self.FIELDS})
+            data.close()
+
+    def _gather(self, field, idxs):
+        if not self.pin_batches:
+            return torch.index_select(self.tensors[field], 0, idxs).to(self.device)
+
+        key = (field, len(idxs))
+        if key not in self.pinned_batches:
+            self.pinned_batches[key] = torch.empty((len(idxs), *self.tensors[field].shape[1:]),
+                                                   dtype=self.tensors[field].dtype, pin_memory=True)
+        torch.index_select(self.tensors[field], 0, idxs, out=self.pinned_batches[key])
+        return self.pinned_batches[key].to(self.device, non_blocking=True)
+
     def sample(self, batch_size):
         idxs = self.randomizer.integers(0,
                                         self.capacity if self.full else self.idx,
                                         size=batch_size)
-        
-
-        obses = torch.as_tensor(self.obses[idxs], device=self.device).float()
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        next_obses = torch.as_tensor(self.next_obses[idxs],
-                                     device=self.device).float()
-        not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
-        not_dones_no_max = torch.as_tensor(self.not_dones_no_max[idxs],
-                                           device=self.device)
-
-        return obses, actions, rewards, next_obses, not_dones, not_dones_no_max
\ No newline at end of file
+        idxs = torch.from_numpy(idxs)
+
+        if self.copy_done is not None:
+            self.copy_done.synchronize()
+
+        obses = self._gather('obses', idxs).float()
+        actions = self._gather('actions', idxs).float()
+        rewards = self._gather('rewards', idxs)
+        next_obses = self._gather('next_obses', idxs).float()
+        not_dones = self._gather('not_dones', idxs)
+        not_dones_no_max = self._gather('not_dones_no_max', idxs)
+
+        if self.pin_batches:
+            self.copy_done = torch.cuda.Event()
+            self.copy_done.record()
+
+        return obses, actions, rewards, next_obses, not_dones, not_dones_no_max
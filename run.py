@@ -11,12 +11,14 @@ import os
 import sys
 import time
 import pickle as pkl
+from concurrent.futures import ThreadPoolExecutor
 
 from logger import Logger
 from replay_buffer import ReplayBuffer
 import utils
 import hydra
 from agent_system import IndividualMultiAgent, SharedMultiAgent
+from agent import Agent
 
 
 class Workspace(object):
@@ -45,6 +47,15 @@ class Workspace(object):
         self.env = utils.import_flow_env(env_name=self.cfg.env, render=self.cfg.render, evaluate=(self.cfg.mode=='eval'))
         self.agent_ids = self.env.agents
 
+        #action range and shape of the environment, equal for all agents
+        self.act_range = [  float(self.env.action_space[self.agent_ids[0]].low.min()),
+                            float(self.env.action_space[self.agent_ids[0]].high.max())]
+        self.act_shape = self.env.action_space[self.agent_ids[0]].shape
+
+        #environments stepped in parallel for collecting training data, started in train
+        self.train_env = None
+        self.env_randomizer_state = None
+
         #initialize loggers
         self.loggers = {}
         self.optim_loggers = None
@@ -56,6 +67,7 @@ class Workspace(object):
                                             agent=self.cfg.agent.name,
                                             file_exists=self.cfg.load_checkpoint)
             
+
         #initialize agents
         self.multi_agent = None
         if self.cfg.multi_agent_mode == 'individual':
@@ -98,6 +110,10 @@ class Workspace(object):
         self.step = 0
         self.episode = 0
         self.min_step_num = 0
+
+        #checkpoints are written to disk in the background, at most one at a time
+        self._ckpt_pool = ThreadPoolExecutor(max_workers=1)
+        self._ckpt_future = None
         
         #load checkpoint
         if self.cfg.load_checkpoint:
@@ -105,13 +121,14 @@ class Workspace(object):
             
             # load states of random number generators
             if self.cfg.mode == 'train':
-                self.env.wrapped_env.load_randomizer_state(env_randomizer_state)
+                self.env_randomizer_state = env_randomizer_state
                 self.initial_randomizer.bit_generator.state = initial_randomizer_state
                 utils.load_randomizer_states(torch_randomizer_state, cuda_randomizer_state, cuda_available = (not self.cfg.device == 'cpu'))
         
 
 
     def evaluate(self):
+        self.multi_agent.set_mode('eval')
         average_episode_rewards = {}
         for agent in self.agent_ids:
             average_episode_rewards[agent] = 0
@@ -129,11 +146,11 @@ class Workspace(object):
                     episode_rewards[agent] = 0
 
             while not done:
-                actions = self.multi_agent.act(obs, sample=False, mode="eval")
+                actions = self.multi_agent.act(obs, sample=False)
                 for agent in self.agent_ids:
                     actions[agent] = utils.scale_action(-1, 1,
-                                                        float(self.env.action_space[self.agent_ids[0]].low.min()),
-                                                        float(self.env.action_space[self.agent_ids[0]].high.max()), 
+                                                        self.act_range[0],
+                                                        self.act_range[1],
                                                         actions[agent])
                 obs, rewards, dones, _ = self.env.step(actions)
                 done = dones['__all__']
@@ -157,108 +174,160 @@ class Workspace(object):
 
 
     def train(self):
-        episode_rewards, done,  = {}, False
-        episode_step, eval_count, checkpoint_count = 0, 0, 0
+        num_envs = self.cfg.num_envs
+        # rows follow the order of self.agent_ids, columns the environments
+        episode_rewards = np.zeros((len(self.agent_ids), num_envs))
+        episode_steps = np.zeros(num_envs, dtype=np.int64)
+        eval_count, checkpoint_count = 0, 0
         virtual_session_step = self.step - self.min_step_num # for consistency reasons
-        for agent in self.agent_ids:
-            episode_rewards[agent] = 0
 
-        self.env.wrapped_env.set_mode('train')
-        obs = self.env.reset()
-        self.multi_agent.reset()
+        # the agents are reset whenever any sub-environment finishes an episode,
+        # so several sub-environments are only supported for agents without per-episode state
+        assert num_envs == 1 or hydra.utils.get_class(self.cfg.agent['class']).reset is Agent.reset, \
+            'agents which override reset require num_envs: 1'
 
-        training_done = False # ensure that the last episode does not get interrupted
+        # the SUMO workers are only started here, so that they are closed by the finally below
+        self.train_env = utils.import_flow_vec_env(env_name=self.cfg.env, render=self.cfg.render, evaluate=False, num_envs=num_envs, seed=self.cfg.overall_seed)
 
-        while not training_done:
-            start_time = time.time()
+        try:
+            if self.env_randomizer_state is not None:
+                self.train_env.load_randomizer_states(self.env_randomizer_state)
 
-            # sample action for data collection
-            if self.step < self.cfg.num_seed_steps:
-                actions = {}
-                for agent in self.agent_ids:
-                    actions[agent] = self.initial_randomizer.uniform(low=float(self.env.action_space[self.agent_ids[0]].low.min()),
-                                                                            high=float(self.env.action_space[self.agent_ids[0]].high.max()))
-            else:
-                actions = self.multi_agent.act(obs, sample=True, mode="eval")
-                #scale actions to the action ranges of the environmnent
-                for agent in self.agent_ids:
-                    actions[agent] = utils.scale_action(-1, 1,
-                                                        float(self.env.action_space[self.agent_ids[0]].low.min()),
-                                                        float(self.env.action_space[self.agent_ids[0]].high.max()), 
-                                                        actions[agent])
+            # finished sub-environments are reset automatically
+            self.train_env.env_method('set_mode', 'train')
+            # randomizer states before drawing the current episode of each sub-environment,
+            # checkpoints store them so that a resumed run draws the same episodes
+            episode_randomizer_states = self.train_env.get_randomizer_states()
+            obs = self.train_env.reset()
+            self.multi_agent.reset()
+            self.multi_agent.set_mode('eval')
 
-            # run training update
-            if self.step >= self.cfg.num_seed_steps:
-                if not (self.cfg.fed_enabled and self.step % self.cfg.fed_frequency == 0) or self.cfg.multi_agent_mode == 'shared':
-                    self.multi_agent.update(self.optim_loggers, self.step)
-                else:
-                    if self.cfg.fed_and_update:
-                        self.multi_agent.update(self.optim_loggers, self.step)
-                    self.multi_agent.federate(self.cfg.fed_actor, self.cfg.fed_critic, self.cfg.fed_target, self.cfg.fed_alpha, self.cfg.fed_pre_weight, self.cfg.fed_post_weight, self.cfg.fed_first_post_weight, self.cfg.fed_last_pre_weight)
+            # ensure that the last episode does not get interrupted, with several sub-environments
+            # only the episode which ends the training is completed, those still running in the others are cut off
+            training_done = False
 
-            # advance one step in the environment
-            next_obs, rewards, dones, _ = self.env.step(actions)
+            episode_start_times = np.full(num_envs, time.time())
+
+            while not training_done:
+                # sample action for data collection
+                if self.step < self.cfg.num_seed_steps:
+                    actions = {}
+                    for agent in self.agent_ids:
+                        actions[agent] = self.initial_randomizer.uniform(low=self.act_range[0],
+                                                                                high=self.act_range[1],
+                                                                                size=(num_envs,) + self.act_shape)
+                else:
+                    actions = self.multi_agent.act(obs, sample=True)
+                    #scale actions to the action ranges of the environmnent
+                    for agent in self.agent_ids:
+                        actions[agent] = utils.scale_action(-1, 1,
+                                                            self.act_range[0],
+                                                            self.act_range[1],
+                                                            actions[agent])
+
+                # run training update, once for every collected environment step
+                if self.step >= self.cfg.num_seed_steps:
+                    for update_step in range(self.step, self.step + num_envs):
+                        if not (self.cfg.fed_enabled and update_step % self.cfg.fed_frequency == 0) or self.cfg.multi_agent_mode == 'shared':
+                            self.multi_agent.update(self.optim_loggers, update_step)
+                        else:
+                            if self.cfg.fed_and_update:
+                                self.multi_agent.update(self.optim_loggers, update_step)
+                            self.multi_agent.federate(self.cfg.fed_actor, self.cfg.fed_critic, self.cfg.fed_target, self.cfg.fed_alpha, self.cfg.fed_pre_weight, self.cfg.fed_post_weight, self.cfg.fed_first_post_weight, self.cfg.fed_last_pre_weight)
+
+                # advance one step in all environments
+                next_obs, rewards, dones, infos = self.train_env.step(actions)
             
-            # allow infinite bootstrap
-            done = float(dones['__all__'])
-            dones_no_max = {}
-            for agent in self.agent_ids:
-                dones_no_max[agent] = 0 if episode_step + 1 == self.env.horizon else dones[agent]
-                episode_rewards[agent] += rewards[agent]
+                # allow infinite bootstrap
+                done = dones['__all__']
+                dones_no_max = {}
+                for agent in self.agent_ids:
+                    dones_no_max[agent] = np.where(episode_steps + 1 == self.env.horizon, 0, dones[agent])
+                episode_rewards += np.stack([rewards[agent] for agent in self.agent_ids])
+
+                # the buffer has to receive the last observation of a finished episode instead of the observation after the reset
+                buffer_next_obs = next_obs
+                if done.any():
+                    buffer_next_obs = {agent: next_obs[agent].copy() for agent in self.agent_ids}
+                    for env_idx in np.flatnonzero(done):
+                        for agent in self.agent_ids:
+                            buffer_next_obs[agent][env_idx] = infos[env_idx]['terminal_observation'][agent]
+                        # recorded for all finished sub-environments before any of them saves a checkpoint below
+                        episode_randomizer_states[env_idx] = infos[env_idx]['randomizer_state']
+
+                # scale actions back to the range of the actor
+                for agent in self.agent_ids:
+                    actions[agent] = utils.scale_action(self.act_range[0],
+                                                        self.act_range[1],
+                                                        -1, 1, actions[agent])
+                self.multi_agent.add_to_buffer(obs, actions, rewards, buffer_next_obs, done.astype(np.float32), dones_no_max)
 
-            # scale actions back to the range of the actor
-            for agent in self.agent_ids:
-                actions[agent] = utils.scale_action(float(self.env.action_space[self.agent_ids[0]].low.min()),
-                                                    float(self.env.action_space[self.agent_ids[0]].high.max()),
-                                                    -1, 1, actions[agent])
-            self.multi_agent.add_to_buffer(obs, actions, rewards, next_obs, done, dones_no_max)
+                obs = next_obs
+                episode_steps += 1
+                self.step += num_envs
+                virtual_session_step += num_envs
 
-            obs = next_obs
-            episode_step += 1
-            self.step += 1
-            virtual_session_step += 1
 
+                for env_idx in np.flatnonzero(done):
 
-            if done:
+                    duration = time.time() - episode_start_times[env_idx]
                 
-                for agent in self.agent_ids:
-                    self.loggers[agent].log('train/duration',
-                                        time.time() - start_time, self.step)
-                    self.loggers[agent].log('train/episode', self.episode, self.step)
-                    self.loggers[agent].log('train/episode_reward', episode_rewards[agent],
-                                           self.step)
-                    self.loggers[agent].dump(
-                                        self.step, save=(self.step > self.cfg.num_seed_steps))
+                    for agent_idx, logger in enumerate(self.loggers.values()):
+                        logger.log('train/duration',
+                                   duration, self.step)
+                        logger.log('train/episode', self.episode, self.step)
+                        logger.log('train/episode_reward', episode_rewards[agent_idx, env_idx],
+                                   self.step)
+                        logger.dump(
+                                   self.step, save=(self.step > self.cfg.num_seed_steps))
                 
-                # in case of a shared multi_agent
-                if self.optim_loggers != self.loggers:
-                    self.optim_loggers.dump(self.step, save=(self.step > self.cfg.num_seed_steps))
+                    # in case of a shared multi_agent
+                    if self.optim_loggers != self.loggers:
+                        self.optim_loggers.dump(self.step, save=(self.step > self.cfg.num_seed_steps))
 
-                utils.print_accumulated_rewards(episode_rewards)
+                    utils.print_accumulated_rewards(dict(zip(self.agent_ids, episode_rewards[:, env_idx])))
                     
-                # evaluate agent periodically
-                if int(virtual_session_step / self.cfg.eval_frequency) > eval_count:
-                    for agent in self.agent_ids:
-                        self.loggers[agent].log('eval/episode', self.episode, self.step)
-                    self.evaluate()
-                    eval_count += 1
-
-                done = False
-                for agent in self.agent_ids:
-                    episode_rewards[agent] = 0
-                episode_step = 0
-                self.episode += 1
-                training_done = self.step >= self.cfg.num_train_steps
+                    # time spent on evaluation and checkpointing is excluded from the durations of all episodes
+                    pause_start = time.time()
+
+                    # evaluate agent periodically
+                    if int(virtual_session_step / self.cfg.eval_frequency) > eval_count:
+                        for agent in self.agent_ids:
+                            self.loggers[agent].log('eval/episode', self.episode, self.step)
+                        self.evaluate()
+                        eval_count += 1
+
+                    episode_rewards[:, env_idx] = 0
+                    episode_steps[env_idx] = 0
+                    self.episode += 1
+                    training_done = self.step >= self.cfg.num_train_steps
                 
-                #save models and optimizers
-                if self.cfg.save_checkpoint and int(virtual_session_step / self.cfg.checkpoint_frequency) > checkpoint_count:
-                    self.min_step_num += self.cfg.checkpoint_frequency
-                    self.multi_agent.save_checkpoint(os.path.join(os.getcwd(), 'checkpoints'), self.step, self.episode, self.min_step_num, self.env.wrapped_env.episode_randomizer.bit_generator.state, self.initial_randomizer.bit_generator.state, torch.get_rng_state(), torch.cuda.get_rng_state() if not self.cfg.device == 'cpu' else 0)
-                    checkpoint_count += 1
-
-                self.env.wrapped_env.set_mode('train')
-                obs = self.env.reset()
-                self.multi_agent.reset()
+                    #save models and optimizers
+                    if self.cfg.save_checkpoint and int(virtual_session_step / self.cfg.checkpoint_frequency) > checkpoint_count:
+                        self.min_step_num += self.cfg.checkpoint_frequency
+                        self.wait_for_checkpoint()
+                        self._ckpt_future = self.multi_agent.save_checkpoint(os.path.join(os.getcwd(), 'checkpoints'), self.step, self.episode, self.min_step_num, list(episode_randomizer_states), self.initial_randomizer.bit_generator.state, torch.get_rng_state(), torch.cuda.get_rng_state() if not self.cfg.device == 'cpu' else 0, executor=self._ckpt_pool)
+                        checkpoint_count += 1
+
+                    episode_start_times += time.time() - pause_start
+
+                    # a no-op for several sub-environments, see the assertion above
+                    self.multi_agent.reset()
+                    episode_start_times[env_idx] = time.time()
+
+            self.wait_for_checkpoint()
+
+        finally:
+            # also on errors, so that no SUMO processes are left behind
+            self._ckpt_pool.shutdown(wait=True)
+            self.train_env.close()
+
+
+    def wait_for_checkpoint(self):
+        # re-raises errors which occurred while writing the checkpoint
+        if self._ckpt_future is not None:
+            self._ckpt_future.result()
+            self._ckpt_future = None
             
 
             
@@ -9,11 +9,14 @@ from collections import deque
 import random
 import math
 import pandas as pd
+import multiprocessing as mp
+from functools import partial
 
 import flow.config as config
 import sys
+import pickle
 from gym.spaces import Box
-from copy import deepcopy
+from copy import deepcopy, copy
 from flow.utils.registry import make_create_env
 
 
@@ -111,6 +114,161 @@ class FlowEnv(gym.Env):
 
 
 #########################################################################################
+# Vectorized flow environment. Every sub-environment runs its own SUMO instance
+# in a worker process so that the simulation steps of all sub-environments overlap.
+
+def import_flow_vec_env(env_name, render, evaluate, num_envs, seed):
+
+    if num_envs < 1:
+        raise ValueError("num_envs must be at least 1, got " + str(num_envs))
+
+    env_fns = [partial(import_flow_env, env_name=env_name, render=render, evaluate=evaluate) for _ in range(num_envs)]
+
+    # independent episode randomizer streams for the additional sub-environments,
+    # the first one keeps the seeding of the environment, as used before the environments were vectorized
+    seed_sequences = [None] + np.random.SeedSequence(seed).spawn(num_envs - 1)
+
+    return SubprocFlowEnv(env_fns, seed_sequences)
+
+
+def _flow_env_worker(remote, parent_remote, env_fn, seed_sequence):
+    parent_remote.close()
+    env = env_fn()
+    if seed_sequence is not None:
+        env.wrapped_env.episode_randomizer = np.random.default_rng(seed_sequence)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                obs, rewards, dones, infos = env.step(data)
+                # autoreset, the last observation of the episode and the randomizer state
+                # before drawing the next episode are passed via the info dict
+                if dones['__all__']:
+                    infos = dict(infos)
+                    infos['terminal_observation'] = obs
+                    infos['randomizer_state'] = env.wrapped_env.episode_randomizer.bit_generator.state
+                    obs = env.reset()
+                remote.send((obs, rewards, dones, infos))
+            elif cmd == 'reset':
+                remote.send(env.reset())
+            elif cmd == 'env_method':
+                method_name, method_args = data
+                remote.send(getattr(env.wrapped_env, method_name)(*method_args))
+            elif cmd == 'get_randomizer_state':
+                remote.send(env.wrapped_env.episode_randomizer.bit_generator.state)
+            elif cmd == 'close':
+                break
+            else:
+                raise ValueError("Unknown command of the flow env worker: " + str(cmd))
+    finally:
+        env.wrapped_env.terminate()
+        remote.close()
+
+
+class SubprocFlowEnv(object):
+    """Steps several flow environments in parallel worker processes.
+
+    Observations, rewards and dones are dictionaries over the agent ids holding
+    arrays with a leading environment dimension. Sub-environments which finish an
+    episode are reset automatically.
+    """
+    def __init__(self, env_fns, seed_sequences=None):
+        self.num_envs = len(env_fns)
+        if seed_sequences is None:
+            seed_sequences = [None] * self.num_envs
+        self.closed = False
+
+        ctx = mp.get_context('spawn')
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for work_remote, remote, env_fn, seed_sequence in zip(work_remotes, self.remotes, env_fns, seed_sequences):
+            process = ctx.Process(target=_flow_env_worker, args=(work_remote, remote, env_fn, seed_sequence), daemon=True)
+            process.start()
+            work_remote.close()
+            self.processes.append(process)
+
+    @staticmethod
+    def _stack(dicts):
+        return {key: np.stack([d[key] for d in dicts]) for key in dicts[0].keys()}
+
+    def step(self, actions):
+        for env_idx, remote in enumerate(self.remotes):
+            remote.send(('step', {agent: actions[agent][env_idx] for agent in actions.keys()}))
+        obs, rewards, dones, infos = zip(*[remote.recv() for remote in self.remotes])
+
+        return self._stack(obs), self._stack(rewards), self._stack(dones), list(infos)
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+
+        return self._stack([remote.recv() for remote in self.remotes])
+
+    def env_method(self, method_name, *method_args):
+        """Calls a method of every wrapped environment."""
+        for remote in self.remotes:
+            remote.send(('env_method', (method_name, method_args)))
+
+        return [remote.recv() for remote in self.remotes]
+
+    def get_randomizer_states(self):
+        for remote in self.remotes:
+            remote.send(('get_randomizer_state', None))
+
+        return [remote.recv() for remote in self.remotes]
+
+    def load_randomizer_states(self, randomizer_states):
+        # checkpoints of a single environment store a single state
+        if not isinstance(randomizer_states, list):
+            randomizer_states = [randomizer_states]
+
+        for remote, randomizer_state in zip(self.remotes, randomizer_states):
+            remote.send(('env_method', ('load_randomizer_state', (randomizer_state,))))
+        for remote in self.remotes[:len(randomizer_states)]:
+            remote.recv()
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            # workers which already exited have closed their end of the pipe
+            try:
+                remote.send(('close', None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+
+#########################################################################################
+
+class PinnedObsStager(object):
+    """Copies observations to a cuda device through preallocated pinned host buffers.
+
+    One pair of host and device buffers is kept per key and observation shape.
+    On other devices the observations are returned unchanged.
+    """
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.enabled = self.device.type == 'cuda'
+        self.pinned_buffers = {}
+        self.device_buffers = {}
+
+    def __call__(self, key, obs):
+        if not self.enabled:
+            return obs
+
+        obs = np.asarray(obs)
+        buffer_key = (key, obs.shape)
+        if buffer_key not in self.pinned_buffers:
+            self.pinned_buffers[buffer_key] = torch.empty(obs.shape, dtype=torch.float32, pin_memory=True)
+            self.device_buffers[buffer_key] = torch.empty(obs.shape, dtype=torch.float32, device=self.device)
+
+        # the previous copy has finished, since the actions of the last step were already transferred back
+        self.pinned_buffers[buffer_key].copy_(torch.from_numpy(obs))
+        return self.device_buffers[buffer_key].copy_(self.pinned_buffers[buffer_key], non_blocking=True)
+
 
 class eval_mode(object):
     def __init__(self, *models):
@@ -158,6 +316,53 @@ def set_seed_everywhere(seed):
         torch.cuda.manual_seed_all(seed)
         torch.backends.cudnn.deterministic = True
 
+def cpu_state_copy(state):
+    """Copies all tensors of a (nested) state dict to the cpu, so that the copy is unaffected by further training."""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        # keeps attributes like the '_metadata' of module state dicts
+        state_copy = copy(state)
+        for key, value in state.items():
+            state_copy[key] = cpu_state_copy(value)
+        return state_copy
+    elif isinstance(state, list):
+        return [cpu_state_copy(value) for value in state]
+    else:
+        return state
+
+def load_torch_checkpoint(path, map_location):
+    """Loads a file saved with torch.save without unpickling arbitrary objects (torch >= 1.13),
+    memory-mapped instead of read into memory if torch >= 2.1.
+
+    Checkpoints written before the optimizer betas were converted to tuples contain omegaconf
+    containers (the betas list and, through its parent reference, the agent config), which are
+    rejected by the weights only unpickler. For these files only the omegaconf containers are
+    allowed additionally (torch >= 2.5), older torch versions refuse to load them.
+    """
+    version = tuple(int(v) for v in torch.__version__.split('.')[:2])
+    kwargs = {}
+    if version >= (2, 1):
+        kwargs['mmap'] = True
+    if version >= (1, 13):
+        try:
+            return torch.load(path, map_location=map_location, weights_only=True, **kwargs)
+        except pickle.UnpicklingError:
+            if not hasattr(torch.serialization, 'safe_globals'):
+                raise
+            from omegaconf import DictConfig, ListConfig
+            print("utils.py warning: " + path + " contains omegaconf objects, loading it with only these allowed additionally")
+            with torch.serialization.safe_globals([DictConfig, ListConfig]):
+                return torch.load(path, map_location=map_location, weights_only=True, **kwargs)
+    return torch.load(path, map_location=map_location)
+
+def tuple_betas(optimizer):
+    """Converts the betas of all parameter groups to tuples, load_state_dict restores them as saved,
+    which are omegaconf lists in checkpoints of older runs."""
+    for group in optimizer.param_groups:
+        if 'betas' in group:
+            group['betas'] = tuple(group['betas'])
+
 def load_randomizer_states(torch_randomizer_state, cuda_randomizer_state, cuda_available):
     torch.set_rng_state(torch_randomizer_state)
     if cuda_available: